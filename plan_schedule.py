@@ -10,12 +10,14 @@
 
 # Our requirements.
 import ephem
+import csv
 import json
 import sys
 import math
 import argparse
-import os
+import subprocess
 import time
+import numpy as np
 import cabb_scheduler as cabb
 import rapid_library.routines as rapidlib
 
@@ -36,23 +38,32 @@ class sourceObservationSet:
             self.scanList.append(sourceObservation(duration=duration, startLST=startLST))
             
 
+# Conversion factors between degrees and radians.
+DEG2RAD = math.pi / 180.0
+RAD2DEG = 180.0 / math.pi
+
+# The ATCA slewing constants.
+vslewaz = (38.0 / 60.0) * DEG2RAD # 38 degrees per minute.
+vslewel = (19.0 / 60.0) * DEG2RAD # 19 degrees per minute.
+accel = (800.0 / 3600.0) * DEG2RAD # 800 degrees/second/second
+azcrit = 0.5 * vslewaz * vslewaz / accel
+elcrit = 0.5 * vslewel * vslewel / accel
+aztcrit = vslewaz / accel
+eltcrit = vslewel / accel
+
+# The scan lengths used for the calibrator and mosaic scans.
+scanLengthCalibrator = rapidlib.minutesToScanLength(5)
+scanLengthMosaic = rapidlib.minutesToScanLength(1)
+
 # This routine calculates the time it takes to slew from one az/el
 # to another az/el.
 def calcSlewTime(oldPosition, newPosition):
     # Given two position structures with az and el, we work out how long it would take
     # for the ATCA to slew between them. Times returned are in seconds.
 
-    # The constants we require.
-    vslewaz = (38.0 / 60.0) * math.pi / 180.0 # 38 degrees per minute.
-    vslewel = (19.0 / 60.0) * math.pi / 180.0 # 19 degrees per minute.
-    accel = (800.0 / 3600.0) * math.pi / 180.0 # 800 degrees/second/second
-    azcrit = 0.5 * vslewaz * vslewaz / accel
-    elcrit = 0.5 * vslewel * vslewel / accel
-    aztcrit = vslewaz / accel
-    eltcrit = vslewel / accel
     # The slewing distance, in radians.
-    deltaAzRadians = abs(newPosition['az'] - oldPosition['az']) * math.pi / 180.0
-    deltaElRadians = abs(newPosition['el'] - oldPosition['el']) * math.pi / 180.0
+    deltaAzRadians = abs(newPosition['az'] - oldPosition['az']) * DEG2RAD
+    deltaElRadians = abs(newPosition['el'] - oldPosition['el']) * DEG2RAD
 
     taz = 0.0
     tel = 0.0
@@ -64,9 +75,19 @@ def calcSlewTime(oldPosition, newPosition):
         tel = 2.0 * math.sqrt(deltaElRadians / accel)
     else:
         tel = eltcrit + (deltaElRadians - elcrit) / vslewel
-    if taz > tel:
-        return taz
-    return tel
+    return max(taz, tel)
+
+# This routine does the same calculation as calcSlewTime, but for arrays of
+# az/el positions (in degrees) all at once. The arrays are broadcast against
+# each other, so one old position can be compared with many new positions.
+def calcSlewTimes(oldAz, oldEl, newAz, newEl):
+    deltaAzRadians = np.abs(newAz - oldAz) * DEG2RAD
+    deltaElRadians = np.abs(newEl - oldEl) * DEG2RAD
+    taz = np.where(deltaAzRadians <= azcrit, 2.0 * np.sqrt(deltaAzRadians / accel),
+                   aztcrit + (deltaAzRadians - azcrit) / vslewaz)
+    tel = np.where(deltaElRadians <= elcrit, 2.0 * np.sqrt(deltaElRadians / accel),
+                   eltcrit + (deltaElRadians - elcrit) / vslewel)
+    return np.maximum(taz, tel)
 
 def createAtcaObject(horizon=12):
     # The location of the ATCA observatory as an PyEphem observer.
@@ -81,27 +102,28 @@ def createAtcaObject(horizon=12):
 def lstToObservatory(observatory=None, startTime=None, targetLst=None):
     if observatory is not None and startTime is not None and targetLst is not None:
         observatory.date = startTime
-        startLst = "%s" % observatory.sidereal_time()
-        aLst = lstToSeconds(startLst)
-        if aLst > 86400:
-            aLst -= 86400
-        bLst = lstToSeconds(targetLst)
-        if bLst > 86400:
-            bLst -= 86400
+        aLst = angleToSeconds(observatory.sidereal_time())
+        targetSeconds = lstToSeconds(targetLst)
+        if targetSeconds > 86400:
+            targetSeconds -= 86400
+        bLst = targetSeconds
         if bLst < aLst:
             bLst += 86400.
         dLst = bLst - aLst
-        while abs(dLst) > 2:
-            dDays = dLst / 86400.
+        nSteps = 0
+        while abs(dLst) > 0.5 and nSteps < 5:
+            # The LST runs faster than the clock, by the ratio of the solar to
+            # the sidereal day, so this step should land (almost) on the target.
+            dDays = (dLst / 86400.) * (86164.0905 / 86400.)
             observatory.date += dDays
-            startLst = "%s" % observatory.sidereal_time()
-            aLst = lstToSeconds(startLst)
-            if aLst > 86400:
-                aLst -= 86400
-            bLst = lstToSeconds(targetLst)
-            if bLst > 86400:
-                bLst -= 86400
-            dLst = bLst - aLst
+            aLst = angleToSeconds(observatory.sidereal_time())
+            dLst = targetSeconds - aLst
+            # Don't let a step across 0h send us a day away.
+            if dLst > 43200.:
+                dLst -= 86400.
+            elif dLst < -43200.:
+                dLst += 86400.
+            nSteps += 1
         
 def createSource(name=None, rightAscension=None, declination=None):
     # Make a pyEphem fixed body object.
@@ -123,15 +145,24 @@ def readSourceList(fname=None, ftype="csv", delimiter=","):
     sources = []
 
     try:
-        with open(fname, 'r') as fp:
+        fp = open(fname, 'r', newline='')
+    except IOError as e:
+        print("Unable to open file %s: %s" % (fname, e))
+        return sources
+
+    with fp:
+        try:
             if ftype == 'csv':
-                # Read the lines, and then strip the crap at the end of each.
-                flines = fp.readlines()
-                flines = [ x.strip() for x in flines ]
                 # Each line must have the name, RA, Dec in that order.
-                # The fields are separated by the specified delimiter.
-                for i in xrange(0, len(flines)):
-                    details = [ x.strip() for x in flines[i].split(delimiter) ]
+                # The fields are separated by the specified delimiter. The csv
+                # module only handles single-character delimiters, so we split
+                # the lines ourselves for longer ones.
+                if len(delimiter) == 1:
+                    rows = csv.reader(fp, delimiter=delimiter)
+                else:
+                    rows = [ x.split(delimiter) for x in fp ]
+                for row in rows:
+                    details = [ x.strip() for x in row ]
                     if len(details) < 3:
                         # This line is unusable.
                         continue
@@ -141,44 +172,230 @@ def readSourceList(fname=None, ftype="csv", delimiter=","):
             elif ftype == 'json':
                 # The JSON should have a top-level property called "sources",
                 # which should be an array.
-                fdata = json.loads(fp.read())
+                fdata = json.load(fp)
                 if 'sources' in fdata:
                     # Each element in the array should be an object with
                     # properties "name", "rightAscension" and "declination".
-                    for i in xrange(0, len(fdata['sources'])):
-                        if ('name' in fdata['sources'][i] and
-                            'rightAscension' in fdata['sources'][i] and
-                            'declination' in fdata['sources'][i]):
-                            sources.append(createSource(name=fdata['sources'][i]['name'],
-                                                        rightAscension=fdata['sources'][i]['rightAscension'],
-                                                        declination=fdata['sources'][i]['declination']))
-    except:
-        e = sys.exc_info()[0]
-        print "Error encountered while reading file: %s" % e
+                    for fsource in fdata['sources']:
+                        if ('name' in fsource and 'rightAscension' in fsource and
+                            'declination' in fsource):
+                            sources.append(createSource(name=fsource['name'],
+                                                        rightAscension=fsource['rightAscension'],
+                                                        declination=fsource['declination']))
+        except (ValueError, TypeError, csv.Error) as e:
+            print("Error encountered while reading file: %s" % e)
 
     return sources
 
+# The az/el (in degrees) of sources we have already calculated, keyed by the
+# source, the observatory and the time (to the nearest hundredth of a second).
+positionCache = {}
+
 def timeToPosition(source=None, observatory=None, time=None):
     if source is not None and observatory is not None and time is not None:
-        observatory.date = time
-        source.compute(observatory)
-        return { 'az': (source.az * 180. / math.pi), 'el': (source.alt * 180. / math.pi) }
+        # The seeding and segment filling ask for the same positions over and over,
+        # so we only change the observatory date when we need a new position.
+        cacheKey = (id(source), id(observatory), int(round(float(time) * 8640000.)))
+        if cacheKey not in positionCache:
+            observatory.date = time
+            source.compute(observatory)
+            positionCache[cacheKey] = ((source.az * RAD2DEG), (source.alt * RAD2DEG))
+        (az, el) = positionCache[cacheKey]
+        return { 'az': az, 'el': el }
+    return None
+
+# The J2000 RA and Dec strings of sources we have already formatted, keyed by
+# the source.
+coordinateStringCache = {}
+
+def coordinateStrings(source=None):
+    # The same sources get written to the atmos files in every slop pass, so
+    # we only format their coordinates once.
+    if source is not None:
+        cacheKey = id(source)
+        if cacheKey not in coordinateStringCache:
+            coordinateStringCache[cacheKey] = (str(source.a_ra), str(source.a_dec))
+        return coordinateStringCache[cacheKey]
+    return None
+
+def sourceCoordinateArrays(sourceList=None, epoch='2000'):
+    # Stack the RA and Dec (in radians) of a list of pyEphem objects into
+    # arrays, so we can calculate positions for all of them at once. The
+    # positions are precessed from J2000 to the specified epoch.
+    if sourceList is not None:
+        ra = np.empty(len(sourceList))
+        dec = np.empty(len(sourceList))
+        for i in range(0, len(sourceList)):
+            position = ephem.Equatorial(ephem.Equatorial(sourceList[i]._ra, sourceList[i]._dec,
+                                                         epoch='2000'), epoch=epoch)
+            ra[i] = position.ra
+            dec[i] = position.dec
+        return (ra, dec)
+    return None
+
+def regularTimes(startTime=None, stopTime=None, step=None):
+    # The times (in days) from startTime, every step, that fall before stopTime.
+    # We count the steps first, because a floating point arange can give us a
+    # time at, or just past, the stop time.
+    if startTime is not None and stopTime is not None and step is not None:
+        nTimes = int(math.ceil((stopTime - startTime) / step - 1e-6))
+        return startTime + np.arange(max(nTimes, 0)) * step
+    return None
+
+def siderealTimeGrid(observatory=None, times=None):
+    # Calculate the LST (in radians) at the observatory for each of the
+    # specified times, using the polynomial for the Greenwich mean sidereal
+    # time rather than asking pyEphem for each time.
+    if observatory is not None and times is not None:
+        # The number of days since J2000 (pyEphem dates are days since 1899/12/31 12:00).
+        days = np.asarray(times, dtype=np.float64) - 36525.
+        centuries = days / 36525.
+        gmst = (280.46061837 + 360.98564736629 * days +
+                (0.000387933 - centuries / 38710000.) * centuries * centuries)
+        return np.mod(np.radians(gmst) + float(observatory.lon), 2. * math.pi)
+    return None
+
+def visibilityGrid(ra=None, dec=None, lst=None, latitude=None, limit=None,
+                   pressure=None, temperature=None):
+    # Work out whether each source is above the elevation limit (in degrees) at
+    # each of the LSTs. The returned array has one row per LST and one column per
+    # source. Rather than calculating every elevation, we compare the sine of
+    # each true elevation with the sine of the true elevation that refraction
+    # (at the specified pressure and temperature) raises to the limit.
+    if (ra is not None and dec is not None and lst is not None and latitude is not None and
+        limit is not None and pressure is not None and temperature is not None):
+        hourAngle = lst[:, np.newaxis] - ra[np.newaxis, :]
+        sinEl = (math.sin(latitude) * np.sin(dec) +
+                 math.cos(latitude) * np.cos(dec) * np.cos(hourAngle))
+        return sinEl > elevationLimitSine(limit, pressure, temperature)
+    return None
+
+def elevationLimitSine(limit=None, pressure=None, temperature=None):
+    # The sine of the true elevation that refraction raises to the specified
+    # elevation limit (in degrees), so that the limit can be compared directly
+    # with the sine of the true elevation of each source.
+    if limit is not None and pressure is not None and temperature is not None:
+        firstGuess = limit - refractionCorrection(limit, pressure, temperature)
+        trueLimit = limit - float(refractionCorrection(firstGuess, pressure, temperature))
+        return math.sin(trueLimit * DEG2RAD)
+    return None
+
+def refractionCorrection(el, pressure, temperature):
+    # The amount (in degrees) that refraction raises a source at the specified
+    # true elevations (in degrees), using the same formulae as pyEphem, for the
+    # pressure (in mB) and temperature (in C) of the observer. Sources below the
+    # horizon are not corrected.
+    lowEl = np.clip(el, 0., 15.)
+    lowCorrection = (((2e-5 * lowEl + 1.96e-2) * lowEl + 1.594e-1) * pressure /
+                     ((273. + temperature) * ((8.45e-2 * lowEl + 5.05e-1) * lowEl + 1.)))
+    highCorrection = np.degrees(7.888888e-5 * pressure /
+                                ((273. + temperature) * np.tan(np.radians(np.maximum(el, 15.)))))
+    return np.where(el < 0., 0., np.where(el < 15., lowCorrection, highCorrection))
+
+def visibilityStatistics(ra=None, dec=None, times=None, step=None, stopTime=None,
+                         observatory=None, limit=None, blockSize=1440):
+    # Work out, in a single pass through the times, how long (in minutes) each
+    # source is above the elevation limit, and when it rises and sets. For each
+    # source we return a sorted array of times, alternating between rising and
+    # setting; a source that is up at the first time rises then, and a source
+    # that is still up at the last time sets one step later, or at the stop
+    # time if that comes first.
+    # The visibility grid can get big, so we only ever make it for one block of
+    # times, and we only need to know the elevations to a small fraction of a
+    # degree, so we do this in single precision.
+    if (ra is not None and dec is not None and times is not None and step is not None and
+        stopTime is not None and observatory is not None and limit is not None):
+        ra = np.asarray(ra, dtype=np.float32)
+        dec = np.asarray(dec, dtype=np.float32)
+        if len(ra) == 0 or len(times) == 0:
+            # No source can be up, and none of them rise or set.
+            return (np.zeros(len(ra)), [ np.array([], dtype=np.float64) for x in ra ])
+        upCounts = np.zeros(len(ra), dtype=np.int64)
+        previousUp = np.zeros(len(ra), dtype=bool)
+        eventTimes = []
+        eventSources = []
+        for i in range(0, len(times), blockSize):
+            blockTimes = times[i:(i + blockSize)]
+            blockUp = visibilityGrid(ra=ra, dec=dec,
+                                     lst=siderealTimeGrid(observatory, blockTimes).astype(np.float32),
+                                     latitude=float(observatory.lat), limit=limit,
+                                     pressure=observatory.pressure, temperature=observatory.temp)
+            upCounts += blockUp.sum(axis=0)
+            # Compare each row with the one before it, including the last row of
+            # the previous block.
+            changes = np.vstack((previousUp, blockUp))
+            (rows, cols) = np.nonzero(changes[1:] != changes[:-1])
+            eventTimes.append(blockTimes[rows])
+            eventSources.append(cols)
+            previousUp = blockUp[-1]
+        cols = np.nonzero(previousUp)[0]
+        eventTimes.append(np.full(len(cols), min(times[-1] + step, float(stopTime))))
+        eventSources.append(cols)
+        # Group the events by source, keeping them in time order.
+        eventTimes = np.concatenate(eventTimes)
+        eventSources = np.concatenate(eventSources)
+        order = np.argsort(eventSources, kind='stable')
+        splits = np.cumsum(np.bincount(eventSources, minlength=len(ra)))[:-1]
+        return ((upCounts * (step * 24. * 60.)), np.split(eventTimes[order], splits))
+    return None
+
+def refineRiseSetEvents(events=None, ra=None, dec=None, step=None, observatory=None,
+                        limit=None, firstTime=None, lastTime=None):
+    # The rise and set times from visibilityStatistics are only as good as the
+    # grid step; each crossing happens some time in the step before it. Find
+    # each crossing precisely by searching only within that step, rather than
+    # asking pyEphem to search for the next rising or setting. Times at the
+    # start and end of the period are not real crossings, so are left alone.
+    if (events is not None and ra is not None and dec is not None and step is not None and
+        observatory is not None and limit is not None and firstTime is not None and
+        lastTime is not None):
+        sinLimit = elevationLimitSine(limit, observatory.pressure, observatory.temp)
+        sinLat = math.sin(observatory.lat)
+        cosLat = math.cos(observatory.lat)
+        refined = []
+        for i in range(0, len(ra)):
+            sinDec = math.sin(dec[i])
+            cosDec = math.cos(dec[i])
+            def sinElOffset(t):
+                lst = float(siderealTimeGrid(observatory, t))
+                return sinLat * sinDec + cosLat * cosDec * math.cos(lst - ra[i]) - sinLimit
+            sourceEvents = np.array(events[i], dtype=np.float64)
+            for j in range(0, len(sourceEvents)):
+                if sourceEvents[j] == firstTime or sourceEvents[j] == lastTime:
+                    continue
+                crossing = ephem.newton(sinElOffset, sourceEvents[j] - step, sourceEvents[j])
+                sourceEvents[j] = min(max(crossing, sourceEvents[j] - step), sourceEvents[j])
+            refined.append(sourceEvents)
+        return refined
+    return None
+
+def isUp(events=None, time=None):
+    # Use the rise and set times from visibilityStatistics to work out whether a
+    # source is up at the specified time, which it is if an odd number of
+    # events have happened by then.
+    if events is not None and time is not None:
+        return (np.searchsorted(events, time, side='right') % 2) == 1
+    return None
+
+def dateString(date=None):
+    # Format a pyEphem date the way we write times into program entries.
+    if date is not None:
+        (year, month, day, hour, minute, second) = date.tuple()
+        return "%04d/%02d/%02d %02d:%02d:%02d" % (year, month, day, hour, minute, int(second))
     return None
 
 def programEntry(source=None, observatory=None, startTime=None, duration=None):
     # Create a source entry, and calculate the az/el of the observation.
     if source is not None and observatory is not None and startTime is not None and duration is not None:
-        observatory.date = startTime
-        source.compute(observatory)
+        endTime = ephem.Date(startTime + duration / (24. * 60.))
+        startPosition = timeToPosition(source=source, observatory=observatory, time=startTime)
+        endPosition = timeToPosition(source=source, observatory=observatory, time=endTime)
         entry = { 'name': source.name, 'rightAscension': source.a_ra, 'declination': source.a_dec,
-                  'start': { 'time': startTime.datetime().strftime("%Y/%m/%d %H:%M:%S"),
-                             'az': (source.az * 180.0 / math.pi), 'el': (source.alt * 180.0 / math.pi) }
+                  'start': { 'time': dateString(startTime),
+                             'az': startPosition['az'], 'el': startPosition['el'] },
+                  'end': { 'time': dateString(endTime),
+                           'az': endPosition['az'], 'el': endPosition['el'] }
         }
-        endTime = ephem.Date(startTime + duration / (24. * 60.))
-        observatory.date = endTime
-        source.compute(observatory)
-        entry['end'] = { 'time': endTime.datetime().strftime("%Y/%m/%d %H:%M:%S"),
-                         'az': (source.az * 180.0 / math.pi), 'el': (source.alt * 180.0 / math.pi) }
         return entry
     return None
 
@@ -189,57 +406,74 @@ def lstToSeconds(lstString):
     lst = float(comps[0]) * 3600. + float(comps[1]) * 60. + float(comps[2])
     return lst
 
+def angleToSeconds(angle):
+    # Convert an angle in radians (like an LST from pyEphem) to seconds of time,
+    # without going through its string form.
+    return float(angle) * 43200. / math.pi
+
 def storeSourcesToDict(sourceDict=None, sourceList=None):
     if sourceDict is None:
         sourceDict = {}
     if sourceList is not None:
-        for i in xrange(0, len(sourceList)):
+        for i in range(0, len(sourceList)):
             sourceDict[sourceList[i].name] = sourceList[i]
     return sourceDict
 
 def createSourceFile(seedSource=None, sourceList=None, fileName=None):
     if seedSource is not None and sourceList is not None and fileName is not None:
+        # The seed goes first, then the other sources.
+        lines = [ " ".join((x.name,) + coordinateStrings(x)) + "\n" for x in [ seedSource ] + sourceList ]
         with open(fileName, 'w') as opf:
-            ostring = "%s %s %s\n" % (seedSource.name, seedSource.a_ra,
-                                      seedSource.a_dec)
-            opf.write(ostring)
-            for i in xrange(0, len(sourceList)):
-                ostring = "%s %s %s\n" % (sourceList[i].name, sourceList[i].a_ra,
-                                          sourceList[i].a_dec)
-                opf.write(ostring)
+            opf.write("".join(lines))
                 
 
 def findSegmentSources(seedSource=None, possibleSources=None, maxSlewTime=None, observatory=None,
                        segmentStartTime=None, nVisits=None, maxVisits=None, excludeSources=None,
-                       lowElLimit=12.):
+                       lowElLimit=12., sourceEvents=None):
     if (seedSource is not None and possibleSources is not None and maxSlewTime is not None and
         observatory is not None and segmentStartTime is not None and nVisits is not None and
         maxVisits is not None):
-        segmentSlewTimes = []
+        candidateSources = []
+        candidateAz = []
+        candidateEl = []
         seedPosition = timeToPosition(source=seedSource, observatory=observatory,
                                       time=segmentStartTime)
-        for i in xrange(0, len(possibleSources)):
-            if seedSource.name != possibleSources[i].name:
-                sourcePosition = timeToPosition(source=possibleSources[i], observatory=observatory,
+        for i in range(0, len(possibleSources)):
+            source = possibleSources[i]
+            sourceName = source.name
+            if seedSource.name != sourceName:
+                if (sourceEvents is not None and sourceName in sourceEvents and
+                    not isUp(sourceEvents[sourceName], segmentStartTime)):
+                    # We already know this source isn't up.
+                    continue
+                sourcePosition = timeToPosition(source=source, observatory=observatory,
                                                 time=segmentStartTime)
                 if sourcePosition['el'] > lowElLimit:
-                    segmentSlewTimes.append((possibleSources[i], calcSlewTime(seedPosition, sourcePosition)))
-        sortedSlewTimes = sorted(segmentSlewTimes, key=lambda s: s[1])
+                    candidateSources.append(source)
+                    candidateAz.append(sourcePosition['az'])
+                    candidateEl.append(sourcePosition['el'])
+        # Work out the slew times to all the candidates at once.
+        slewTimes = calcSlewTimes(seedPosition['az'], seedPosition['el'],
+                                  np.array(candidateAz), np.array(candidateEl))
+        slewOrder = np.argsort(slewTimes, kind='stable')
         observeSources = []
         totalSlewTime = 0.
-        for i in xrange(0, len(sortedSlewTimes)):
+        for i in slewOrder:
             if totalSlewTime > maxSlewTime:
                 break
-            if sortedSlewTimes[i][0].name in nVisits and nVisits[sortedSlewTimes[i][0].name] >= maxVisits:
+            source = candidateSources[i]
+            slewTime = slewTimes[i]
+            sourceName = source.name
+            if sourceName in nVisits and nVisits[sourceName] >= maxVisits:
                 continue
-            if excludeSources is not None and sortedSlewTimes[i][0].name in excludeSources:
+            if excludeSources is not None and sourceName in excludeSources:
                 continue
-            totalSlewTime += (sortedSlewTimes[i][1] / 60.)
-            observeSources.append(sortedSlewTimes[i][0])
-            if sortedSlewTimes[i][0].name not in nVisits:
-                nVisits[sortedSlewTimes[i][0].name] = 1
+            totalSlewTime += (slewTime / 60.)
+            observeSources.append(source)
+            if sourceName not in nVisits:
+                nVisits[sourceName] = 1
             else:
-                nVisits[sortedSlewTimes[i][0].name] += 1
+                nVisits[sourceName] += 1
         return observeSources
     return None
 
@@ -247,8 +481,12 @@ def prepareMosaic(fileList=None, mosaicFile=None, lst=None, refPos=None, interva
     # Make a mosaic file and interpret the results.
     if (fileList is not None and mosaicFile is not None and lst is not None and refPos is not None and
         interval is not None and nCycles is not None):
-        atmosCommand = "atmos source=%s out=%s.mos %s lst=%s interval=%d cycles=%d> /dev/null" % (fileList, mosaicFile, refpos, lst, interval, nCycles)
-        os.system(atmosCommand)
+        # Run atmos directly rather than through a shell.
+        atmosCommand = [ "atmos", "source=%s" % fileList, "out=%s.mos" % mosaicFile ]
+        if refPos != "":
+            atmosCommand.append(refPos)
+        atmosCommand.extend([ "lst=%s" % lst, "interval=%d" % interval, "cycles=%d" % nCycles ])
+        subprocess.call(atmosCommand, stdout=subprocess.DEVNULL)
         # Read in the order it was sorted into.
         segstart = ""
         segend = ""
@@ -256,33 +494,33 @@ def prepareMosaic(fileList=None, mosaicFile=None, lst=None, refPos=None, interva
         segdec = ""
         sources = []
         ordered = []
-        with open('%s%d.mos' % (args.mosaic, i), 'r') as ipf:
-            iline = ipf.readline()
-            while (iline != ""):
-                if iline.startswith("#") == False:
-                    linel = [ x.strip() for x in iline.split(" ") ]
-                    sname = linel[-1].replace('$', '')
-                    ordered.append(sname)
-                    if seed is None or seed != sname:
-                        sources.append(sname)
-                else:
-                    linel = [ x.strip() for x in iline.split(" ") ]
-                    if iline.startswith("# Start LST is"):
-                        segstart = linel[4]
-                    elif iline.startswith("# End LST is"):
-                        segend = linel[4]
-                    elif iline.startswith("# Reference position ="):
-                        segra = linel[4]
-                        segdec = linel[5]
-                iline = ipf.readline()
+        with open('%s.mos' % mosaicFile, 'r') as ipf:
+            mosLines = ipf.read().splitlines()
+        for iline in mosLines:
+            if iline.startswith("# Start LST is"):
+                segstart = iline.split(" ")[4].strip()
+            elif iline.startswith("# End LST is"):
+                segend = iline.split(" ")[4].strip()
+            elif iline.startswith("# Reference position ="):
+                linel = iline.split(" ")
+                segra = linel[4].strip()
+                segdec = linel[5].strip()
+            elif iline.startswith("#") == False and iline.strip() != "":
+                # The source name is the last thing on the line.
+                sname = iline.split(" ")[-1].strip().replace('$', '')
+                ordered.append(sname)
+                if seed is None or seed != sname:
+                    sources.append(sname)
         # Work out how long this schedule goes for.
         startLst = lstToSeconds(segstart)
         endLst = lstToSeconds(segend)
-        if endLst < startLst:
+        runEndLst = endLst
+        if runEndLst < startLst:
             # Date change.
-            endLst += 86400.
-        duration = (endLst - startLst) * (24. / (23.+ 56. / 60.))
+            runEndLst += 86400.
+        duration = (runEndLst - startLst) * (24. / (23.+ 56. / 60.))
         return { 'startLST': segstart, 'endLST': segend, 'sources': sources,
+                 'startLSTSeconds': startLst, 'endLSTSeconds': endLst,
                  'orderedSources': ordered,
                  'refRA': segra, 'refDec': segdec, 'duration': duration }
     return None
@@ -316,7 +554,7 @@ parser.add_argument('-z', "--minel", default=20.0, type=float,
 parser.add_argument('-i', "--initsource", default="",
                     help="the name of the source that you will be observing at the start")
 parser.add_argument('-c', "--csvdelim", default=",",
-                    help="the delimiter for the CSV file supplied as the source list")
+                    help="the delimiter for the CSV source list, and the altered list if it is a CSV file")
 parser.add_argument('-C', "--cycletime", default=10.0, type=float,
                     help="the correlator cycle time in seconds")
 parser.add_argument('-S', "--slewing", default=1.0, type=float,
@@ -333,11 +571,13 @@ parser.add_argument('-a', "--altered", default="",
                     help="the name of the file to output with the list of sources, excluding the ones successfully scheduled")
 parser.add_argument('-L', "--slop", default=20.0, type=float,
                     help="the maximum amount of slop in the schedule, in minutes")
+parser.add_argument('-f', "--startcal", default="", choices=[ "", "1934", "0823" ],
+                    help="start the schedule on this calibrator, without checking whether 1934-638 is up")
 
 args = parser.parse_args()
 
 if args.sourcelist == "":
-    print "source list not specified!"
+    print("source list not specified!")
     sys.exit(-1)
 
 # Start by reading in the source list.
@@ -346,7 +586,10 @@ if args.sourcelist.endswith(".json"):
 else:
     sourceList = readSourceList(args.sourcelist, delimiter=args.csvdelim)
 
-print "Read in %d sources from %s" % (len(sourceList), args.sourcelist)
+print("Read in %d sources from %s" % (len(sourceList), args.sourcelist))
+if len(sourceList) == 0:
+    print("No sources to schedule!")
+    sys.exit(-1)
 
 # Create the observatory.
 atca = createAtcaObject(horizon=args.minel)
@@ -354,45 +597,50 @@ atca = createAtcaObject(horizon=args.minel)
 # The first step is to get rid of all sources that can't be observed in the
 # required way in the requested period.
 # First cull, get rid of any sources that aren't up at all in the requested period.
-# To do this, we set the time at the observatory to be the start of the period.
 # We leave 15 minutes at the start and end of the period for calibration.
 try:
     startDate = ephem.Date(args.starttime.replace('-', '/').replace(':', ' ', 1)) + (15. / (24. * 60.))
     stopDate = ephem.Date(args.endtime.replace('-', '/').replace(':', ' ', 1)) - (15. / (24. * 60.))
 except ValueError:
-    print "Incorrectly specified start or end time."
+    print("Incorrectly specified start or end time.")
     sys.exit(-1)
     
-atca.date = startDate
-badSources = []
-for i in xrange(0, len(sourceList)):
-    # Compute the parameters at the time and place.
-    sourceList[i].compute(atca)
-    # Get the next rise time if the source is not already above the nominated horizon.
-    startEl = sourceList[i].alt * 180.0 / math.pi
-    if startEl < args.minel:
-        # We don't check for something that is already above the horizon,
-        # because that is already a source that is up during the requested
-        # period.
-        try:
-            riseTime = atca.next_rising(sourceList[i], start=startDate)
-        except ephem.NeverUpError:
-            # We remove this source, it is never up.
-            badSources.append(i)
-            continue
-        #print "Source %d (%s): rises at %s" % ((i + 1), sourceList[i].name,
-        #                                       riseTime)
-        if riseTime >= stopDate:
-            #print "  this is after the end of the slot"
-            badSources.append(i)
-
-print "Found %d sources that will not be above the horizon in your slot." % len(badSources)
-removedSources = []
-for i in xrange(len(sourceList) - 1, -1, -1):
-    if i in badSources:
-        removedSources.append(sourceList[i])
-        del sourceList[i]
-print "There are now %d sources remaining." % len(sourceList)
+# Rather than asking pyEphem when each source rises and sets, we work out the
+# elevation of every source at each minute of the period in one go.
+gridStep = 1. / (24. * 60.) # one minute, in days
+gridTimes = regularTimes(startDate, stopDate, gridStep)
+if len(gridTimes) == 0:
+    print("The observing block is too short to schedule any sources.")
+    sys.exit(-1)
+# We keep the source positions in arrays alongside the list of sources, and
+# cull them together.
+(sourceRA, sourceDec) = sourceCoordinateArrays(sourceList, epoch=startDate)
+# Work out how long each source is up for, and keep the times that each
+# source rises and sets, so we don't need to work them out again.
+(sourceUpTimes, gridEvents) = visibilityStatistics(ra=sourceRA, dec=sourceDec, times=gridTimes,
+                                                   step=gridStep, stopTime=stopDate,
+                                                   observatory=atca, limit=args.minel)
+gridEvents = refineRiseSetEvents(events=gridEvents, ra=sourceRA, dec=sourceDec, step=gridStep,
+                                 observatory=atca, limit=args.minel, firstTime=gridTimes[0],
+                                 lastTime=min(gridTimes[-1] + gridStep, float(stopDate)))
+# The up times from the grid can be out by up to a step at each crossing, so
+# work them out again from the refined rise and set times (in minutes).
+sourceUpTimes = np.array([ (e[1::2] - e[0::2]).sum() * (24. * 60.) for e in gridEvents ])
+sourceEvents = {}
+badSources = set()
+for i in range(0, len(sourceList)):
+    sourceEvents[sourceList[i].name] = gridEvents[i]
+    if len(gridEvents[i]) == 0:
+        # This source never rises during the requested period.
+        badSources.add(i)
+
+print("Found %d sources that will not be above the horizon in your slot." % len(badSources))
+removedSources = [ s for (i, s) in enumerate(sourceList) if i in badSources ]
+sourceList = [ s for (i, s) in enumerate(sourceList) if i not in badSources ]
+sourceRA = np.delete(sourceRA, list(badSources))
+sourceDec = np.delete(sourceDec, list(badSources))
+sourceUpTimes = np.delete(sourceUpTimes, list(badSources))
+print("There are now %d sources remaining." % len(sourceList))
 
 # Second cull, from the sources that do rise, how many are above the horizon for 20%
 # more time than it would take to observe them the required number of times with
@@ -400,147 +648,110 @@ print "There are now %d sources remaining." % len(sourceList)
 # The minimum amount of time required above the horizon:
 fullDuration = args.duration + (2. * args.cycletime / 60.)
 minTime = 1.2 * float(args.nvisits) * (fullDuration + args.spacing)
-print "The minimum above-horizon time for any source is %.1f minutes." % minTime
+print("The minimum above-horizon time for any source is %.1f minutes." % minTime)
 # Find the above-horizon time for each source.
-badSources = []
-sourceTimes = {}
-for i in xrange(0, len(sourceList)):
-    #print "  examining source %d (%s):" % ((i + 1), sourceList[i].name)
-    checkTime = startDate
+badSources = set()
+for i in range(0, len(sourceList)):
     # The total time above the horizon (minutes).
-    timeUp = 0.
-    lastUp = False
-    while checkTime < stopDate:
-        atca.date = checkTime
-        sourceList[i].compute(atca)
-        el = sourceList[i].alt * 180.0 / math.pi
-        if ((lastUp == True and el < (args.minel * 1.01)) or
-            (lastUp == False and el < (args.minel * 0.99))):
-            #print "    at %s source is not up (el=%.1f)" % (checkTime, el)
-            checkTime = atca.next_rising(sourceList[i], start=checkTime)
-            lastUp = False
-        else:
-            #print "    at %s source is up (el=%.1f)" % (checkTime, el)
-            lastUp = True
-            try:
-                setTime = atca.next_setting(sourceList[i], start=checkTime)
-            except ephem.AlwaysUpError:
-                checkTime = stopDate
-                timeUp = (stopDate - startDate) * (24. * 60.)
-                break
-            if setTime <= stopDate:
-                timeUp += (setTime - checkTime) * (24. * 60.)
-                checkTime = setTime
-            else:
-                timeUp += (stopDate - checkTime) * (24. * 60.)
-                checkTime = stopDate
-                break
-            
-    #print "Source %d (%s) is up for a total of %.1f minutes." % ((i + 1), sourceList[i].name,
-    #                                                             timeUp)
-    if timeUp < minTime:
-        #print "  not long enough"
-        badSources.append(i)
-    else:
-        sourceTimes[sourceList[i].name] = timeUp
+    if sourceUpTimes[i] < minTime:
+        badSources.add(i)
 
-print "Found %d sources that will not be above the horizon long enough." % len(badSources)
-for i in xrange(len(sourceList) - 1, -1, -1):
-    if i in badSources:
-        removedSources.append(sourceList[i])
-        del sourceList[i]
-print "There are now %d sources remaining." % len(sourceList)
+print("Found %d sources that will not be above the horizon long enough." % len(badSources))
+removedSources.extend([ s for (i, s) in enumerate(sourceList) if i in badSources ])
+sourceList = [ s for (i, s) in enumerate(sourceList) if i not in badSources ]
+sourceRA = np.delete(sourceRA, list(badSources))
+sourceDec = np.delete(sourceDec, list(badSources))
+print("There are now %d sources remaining." % len(sourceList))
 
 # Split up the time into segments, where each segment is half the minimum spacing.
 halfSpacing = (args.spacing / 2.) / (24. * 60.) # in days
-segmentTimes = [ ephem.Date(startDate) ]
-ntime = ephem.Date(startDate + halfSpacing)
-while ntime < stopDate:
-    segmentTimes.append(ntime)
-    ntime = ephem.Date(ntime + halfSpacing)
+# The segment start times are kept as plain pyEphem day numbers.
+segmentTimes = regularTimes(startDate, stopDate, halfSpacing)
 
 segmentSources = []
 segmentSeeds = []
-segmentsUp = {}
-for i in xrange(0, len(sourceList)):
-    segmentsUp[sourceList[i].name] = 0
-    
-for i in xrange(0, len(segmentTimes)):
+# Work out which sources are up at the half-way point of each segment.
+segmentMidTimes = segmentTimes + (halfSpacing / 2.)
+segmentUp = visibilityGrid(ra=sourceRA, dec=sourceDec,
+                           lst=siderealTimeGrid(atca, segmentMidTimes),
+                           latitude=float(atca.lat), limit=args.minel,
+                           pressure=atca.pressure, temperature=atca.temp)
+# The number of segments each source is up in.
+segmentsUp = segmentUp.sum(axis=0)
+for i in range(0, len(segmentTimes)):
     ssources = []
-    print "Segment %d, %s" % ((i + 1), segmentTimes[i])
+    print("Segment %d, %s" % ((i + 1), ephem.Date(segmentTimes[i])))
     # Find all the sources up at the half-way point of this segment.
-    atca.date = ephem.Date(segmentTimes[i] + halfSpacing / 2.)
-    for j in xrange(0, len(sourceList)):
-        sourceList[j].compute(atca)
-        el = sourceList[j].alt * 180.0 / math.pi
-        if (el > args.minel):
+    for j in range(0, len(sourceList)):
+        if segmentUp[i, j]:
             ssources.append(sourceList[j])
-            segmentsUp[sourceList[j].name] += 1
     segmentSources.append(ssources)
     segmentSeeds.append(None)
-    print "  there are %d sources up in this segment" % len(ssources)
-
-while None in segmentSeeds and segmentsUp:
-    # Find the most constraining source, and we'll lock it in as the immovable object.
-    seedSourceName = min(segmentsUp, key=segmentsUp.get)
-    print "most constraining source is %s, which is observable in only %d segments" % (seedSourceName, segmentsUp[seedSourceName])
-    seedSource = None
-    for i in xrange(0, len(sourceList)):
-        if seedSourceName == sourceList[i].name:
-            seedSource = sourceList[i]
-            break
-    if seedSource is None:
-        del segmentsUp[seedSourceName]
-        continue
+    print("  there are %d sources up in this segment" % len(ssources))
+
+# Keep track of which segments have been seeded, and where each seed is at
+# the start of its segment.
+seededSegments = []
+segmentSeedPositions = [ None for x in segmentSeeds ]
+nUnseeded = len(segmentSeeds)
+# The number of segments each source is up in doesn't change as we seed, so we
+# can put the sources in order of how constraining they are just once.
+for seedIndex in np.argsort(segmentsUp, kind='stable'):
+    if nUnseeded == 0:
+        break
+    # Take the most constraining source, and we'll lock it in as the immovable object.
+    seedSource = sourceList[seedIndex]
+    seedSourceName = seedSource.name
+    print("most constraining source is %s, which is observable in only %d segments" % (seedSourceName, segmentsUp[seedIndex]))
     # Check all other seed sources, to make sure this one is not very close to those
     # others.
     sourceFailed = False
-    for i in xrange(0, len(segmentSeeds)):
-        if segmentSeeds[i] is not None:
-            seedPosition = timeToPosition(segmentSeeds[i], atca, segmentTimes[i])
-            checkPosition = timeToPosition(seedSource, atca, segmentTimes[i])
-            slew = calcSlewTime(seedPosition, checkPosition) / 60. # in minutes.
-            if slew < args.slewing:
-                print "   source too close to another seed"
-                sourceFailed = True
-                break
+    if len(seededSegments) > 0:
+        seedPositions = [ segmentSeedPositions[i] for i in seededSegments ]
+        checkPositions = [ timeToPosition(seedSource, atca, segmentTimes[i]) for i in seededSegments ]
+        slews = calcSlewTimes(np.array([ x['az'] for x in seedPositions ]),
+                              np.array([ x['el'] for x in seedPositions ]),
+                              np.array([ x['az'] for x in checkPositions ]),
+                              np.array([ x['el'] for x in checkPositions ])) / 60. # in minutes.
+        if (slews < args.slewing).any():
+            print("   source too close to another seed")
+            sourceFailed = True
     if sourceFailed == True:
-        print " source is not suitable for seeding"
-        del segmentsUp[seedSourceName]
+        print(" source is not suitable for seeding")
         continue
     # Can we seed some segments.
     psegments = []
-    for i in xrange(0, len(segmentSources)):
-        if seedSource in segmentSources[i]:
-            if segmentSeeds[i] is None:
-                if len(psegments) > 0 and (i - psegments[-1]) < 2:
+    # We only need to look at the segments that this source is up in.
+    for i in np.nonzero(segmentUp[:, seedIndex])[0]:
+        if segmentSeeds[i] is None:
+            if len(psegments) > 0 and (i - psegments[-1]) < 2:
+                continue
+            checkPosition = timeToPosition(seedSource, atca, segmentTimes[i])
+            if i > 0 and segmentSeeds[i - 1] is not None:
+                # Check we're not too far away from this seed.
+                slew = calcSlewTime(segmentSeedPositions[i - 1], checkPosition) / 60.
+                if slew > args.adjacent:
                     continue
-                if i > 0 and segmentSeeds[i - 1] is not None:
-                    # Check we're not too far away from this seed.
-                    seedPosition = timeToPosition(segmentSeeds[i - 1], atca, segmentTimes[i - 1])
-                    checkPosition = timeToPosition(seedSource, atca, segmentTimes[i])
-                    slew = calcSlewTime(seedPosition, checkPosition) / 60.
-                    if slew > args.adjacent:
-                        continue
-                if (i + 1) < len(segmentSources) and segmentSeeds[i + 1] is not None:
-                    seedPosition = timeToPosition(segmentSeeds[i + 1], atca, segmentTimes[i + 1])
-                    checkPosition = timeToPosition(seedSource, atca, segmentTimes[i])
-                    slew = calcSlewTime(seedPosition, checkPosition) / 60.
-                    if slew > args.adjacent:
-                        continue
-                psegments.append(i)
+            if (i + 1) < len(segmentSources) and segmentSeeds[i + 1] is not None:
+                slew = calcSlewTime(segmentSeedPositions[i + 1], checkPosition) / 60.
+                if slew > args.adjacent:
+                    continue
+            psegments.append(i)
     if len(psegments) >= args.nvisits:
         # We can add this source as some seeds.
-        for i in xrange(0, args.nvisits):
-            print "Adding %s as seed of segment %d" % (seedSourceName, psegments[i])
+        for i in range(0, args.nvisits):
+            print("Adding %s as seed of segment %d" % (seedSourceName, psegments[i]))
             segmentSeeds[psegments[i]] = seedSource
-    del segmentsUp[seedSourceName]
+            seededSegments.append(psegments[i])
+            segmentSeedPositions[psegments[i]] = timeToPosition(seedSource, atca,
+                                                                segmentTimes[psegments[i]])
+            nUnseeded -= 1
 
-for i in xrange(0, len(segmentSeeds)):
+for i in range(0, len(segmentSeeds)):
     if segmentSeeds[i] is None:
-        print "Segment %d has no seed" % (i + 1)
+        print("Segment %d has no seed" % (i + 1))
     else:
-        print "Segment %d is seeded by %s" % ((i + 1), segmentSeeds[i].name)
+        print("Segment %d is seeded by %s" % ((i + 1), segmentSeeds[i].name))
 
     
         
@@ -552,23 +763,30 @@ for i in xrange(0, len(segmentSeeds)):
 integrationPerSegment = 0.85 * halfSpacing * (60. * 24.) # in minutes
 maxSlewTime = 0.15 * halfSpacing * (60. * 24.)
 nSourcesPerSegment = int(math.floor(integrationPerSegment / fullDuration))
-extraSlewTime = [ 0. for x in segmentSeeds ]
+extraSlewTime = np.zeros(len(segmentSeeds))
 slop = args.slop + 1.
 excludeSources = [ x.name if x is not None else None for x in segmentSeeds ]
+# The segments that have a seed don't change between iterations either.
+seededIndices = [ i for i in range(0, len(segmentSeeds)) if segmentSeeds[i] is not None ]
+# The LST at the start of each segment doesn't change between iterations.
+segmentLsts = []
+for i in range(0, len(segmentTimes)):
+    atca.date = segmentTimes[i]
+    segmentLsts.append(atca.sidereal_time())
 while slop > args.slop:
     lastSource = None
     segmentOrdered = []
     segmentEstimates = []
     seedAssociations = {}
     sourceVisits = {}
-    for i in xrange(0, len(segmentSeeds)):
+    for i in range(0, len(segmentSeeds)):
         # For each segment, sort the sources by increasing slew time from
         # the seed source, and select the closest nSourcesPerSegment.
         segmentOrdered.append([])
         if segmentSeeds[i] is None:
             segmentEstimates.append(None)
             continue
-        print "Segment %d:" % i
+        print("Segment %d:" % i)
         sourcesInSegment = []
         if segmentSeeds[i].name in seedAssociations:
             sourcesInSegment = findSegmentSources(seedSource=segmentSeeds[i], nVisits=sourceVisits,
@@ -576,23 +794,22 @@ while slop > args.slop:
                                                   maxSlewTime=(maxSlewTime + extraSlewTime[i]),
                                                   observatory=atca, segmentStartTime=segmentTimes[i],
                                                   maxVisits=args.nvisits, excludeSources=excludeSources,
-                                                  lowElLimit=args.minel)
+                                                  lowElLimit=args.minel, sourceEvents=sourceEvents)
         else:
             sourcesInSegment = findSegmentSources(seedSource=segmentSeeds[i], nVisits=sourceVisits,
                                                   possibleSources=segmentSources[i],
                                                   maxSlewTime=(maxSlewTime + extraSlewTime[i]),
                                                   observatory=atca, segmentStartTime=segmentTimes[i],
                                                   maxVisits=args.nvisits, excludeSources=excludeSources,
-                                                  lowElLimit=args.minel)
+                                                  lowElLimit=args.minel, sourceEvents=sourceEvents)
             seedAssociations[segmentSeeds[i]] = sourcesInSegment
         # Make the mosaic file.
         createSourceFile(seedSource=segmentSeeds[i], sourceList=sourcesInSegment, fileName="temp_atmos.txt")
         refpos = ""
         if lastSource is not None:
-            refpos = "ref=%s,%s,%s" % (lastSource.name, lastSource.a_ra, lastSource.a_dec)
-        atca.date = segmentTimes[i]
+            refpos = "ref=%s,%s,%s" % ((lastSource.name,) + coordinateStrings(lastSource))
         mosaicResult = prepareMosaic(fileList="temp_atmos.txt", mosaicFile="%s%d" % (args.mosaic, i),
-                                     seed=segmentSeeds[i].name, lst=atca.sidereal_time(), refPos=refpos,
+                                     seed=segmentSeeds[i].name, lst=segmentLsts[i], refPos=refpos,
                                      interval=int(args.cycletime), nCycles=int((args.duration * 60.) / args.cycletime))
         # Keep a dictionary.
         tstore = storeSourcesToDict(sourceList=[ segmentSeeds[i] ])
@@ -602,46 +819,49 @@ while slop > args.slop:
         segmentOrdered[i] = [ tstore[x] for x in mosaicResult['orderedSources'] ]
         lastSource = tstore[mosaicResult['orderedSources'][-1]]
         segmentEstimates.append(mosaicResult)
-        for j in xrange(0, len(segmentOrdered[i])):
-            print " src %d: %s %s %s" % ((j + 1), segmentOrdered[i][j].name,
-                                         segmentOrdered[i][j].a_ra,
-                                         segmentOrdered[i][j].a_dec)
+        for j in range(0, len(segmentOrdered[i])):
+            print(" src %d: %s %s %s" % (((j + 1), segmentOrdered[i][j].name) +
+                                         coordinateStrings(segmentOrdered[i][j])))
 
     # Work out tha amount of slop in the schedule.
-    slop = 0.
-    print "schedule estimated times follow:"
+    print("schedule estimated times follow:")
     totalSourceVisits = 0
-    diffBack = 1
-    for i in xrange(0, len(segmentSeeds)):
-        if segmentSeeds[i] is None:
-            diffBack += 1
-            continue
-        print "  segment %d: LST %s - %s, %d sources" % (i, segmentEstimates[i]['startLST'],
-                                                         segmentEstimates[i]['endLST'],
-                                                         len(segmentOrdered[i]))
-        # Work out the slew time between the last source and the projected next LST.
-        if i > 0:
-            lstToObservatory(atca, ephem.Date(startDate), segmentEstimates[i - diffBack]['endLST'])
-            lastPos = timeToPosition(source=segmentOrdered[i - diffBack][-1], observatory=atca,
-                                     time=atca.date)
-            nextPos = timeToPosition(source=segmentOrdered[i][0], observatory=atca,
-                                     time=atca.date)
-            segSlew = calcSlewTime(lastPos, nextPos)
-            # And then work out the LST difference.
-            lstDiff1 = lstToSeconds(segmentEstimates[i]['startLST']) - lstToSeconds(segmentEstimates[i - diffBack]['endLST'])
-            lstDiff2 = (lstToSeconds(segmentEstimates[i]['startLST']) + 86400) - lstToSeconds(segmentEstimates[i - diffBack]['endLST'])
-            lstDiff = lstDiff1
-            if abs(lstDiff2) < abs(lstDiff1):
-                lstDiff = lstDiff2
-            # The slewing time doesn't count as slop.
-            slopDiff = lstDiff - segSlew
-            slop += slopDiff / 60.
-            # Add more time to a segment is the slop is way too big.
-            if (slopDiff > 120):
-                extraSlewTime[i - diffBack] += (slopDiff / 120.)
-            print "             (LST diff = %.2f s, slew = %.2f s, slop %.2f min)" % (lstDiff, segSlew, (slopDiff / 60.))
-            diffBack = 1
-        print "             (extra slew time = %.2f min, total slop %.2f min)" % (extraSlewTime[i], slop)
+    # Work out the slew time between the last source of each seeded segment and
+    # the first source of the next one, at the projected end LST.
+    segSlews = []
+    for k in range(1, len(seededIndices)):
+        lstToObservatory(atca, startDate, segmentEstimates[seededIndices[k - 1]]['endLST'])
+        lastPos = timeToPosition(source=segmentOrdered[seededIndices[k - 1]][-1], observatory=atca,
+                                 time=atca.date)
+        nextPos = timeToPosition(source=segmentOrdered[seededIndices[k]][0], observatory=atca,
+                                 time=atca.date)
+        segSlews.append(calcSlewTime(lastPos, nextPos))
+    segSlews = np.array(segSlews, dtype=np.float64)
+    # And then work out the LST differences, across a date change if that's closer.
+    startSeconds = np.array([ segmentEstimates[i]['startLSTSeconds'] for i in seededIndices[1:] ],
+                            dtype=np.float64)
+    endSeconds = np.array([ segmentEstimates[i]['endLSTSeconds'] for i in seededIndices[:-1] ],
+                          dtype=np.float64)
+    lstDiff1 = startSeconds - endSeconds
+    lstDiff2 = lstDiff1 + 86400
+    lstDiffs = np.where(np.abs(lstDiff2) < np.abs(lstDiff1), lstDiff2, lstDiff1)
+    # The slewing time doesn't count as slop.
+    slopDiffs = lstDiffs - segSlews
+    totalSlops = np.concatenate(([ 0. ], np.cumsum(slopDiffs / 60.)))
+    # Collect the report lines and output them all together.
+    slopLines = []
+    for k in range(0, len(seededIndices)):
+        i = seededIndices[k]
+        slopLines.append("  segment %d: LST %s - %s, %d sources\n" % (i, segmentEstimates[i]['startLST'],
+                                                                    segmentEstimates[i]['endLST'],
+                                                                    len(segmentOrdered[i])))
+        if k > 0:
+            slopLines.append("             (LST diff = %.2f s, slew = %.2f s, slop %.2f min)\n" % (lstDiffs[k - 1], segSlews[k - 1], (slopDiffs[k - 1] / 60.)))
+        slopLines.append("             (extra slew time = %.2f min, total slop %.2f min)\n" % (extraSlewTime[i], totalSlops[k]))
+    sys.stdout.write("".join(slopLines))
+    slop = totalSlops[-1]
+    # Add more time to a segment if the slop after it is way too big.
+    extraSlewTime[seededIndices[:-1]] += np.where(slopDiffs > 120, slopDiffs / 120., 0.)
 
             
 # Create a CABB schedule.
@@ -652,61 +872,57 @@ source1934 = createSource(name="1934-638", rightAscension="19:39:25.026",
                           declination="-63:42:45.63")
 source0823 = createSource(name="0823-500", rightAscension="08:25:26.869",
                           declination="-50:10:38.49")
-source1934.compute(atca)
-el1934 = source1934.alt * 180. / math.pi
 startSource = None
-if el1934 >= args.minel:
-    # We start on 1934-638.
+if args.startcal == "1934":
     startSource = source1934
-else:
-    # We start on 0823-500.
+elif args.startcal == "0823":
     startSource = source0823
+else:
+    source1934.compute(atca)
+    el1934 = source1934.alt * RAD2DEG
+    if el1934 >= args.minel:
+        # We start on 1934-638.
+        startSource = source1934
+    else:
+        # We start on 0823-500.
+        startSource = source0823
 schedule.addScan({
     'source': startSource.name, 'rightAscension': startSource.a_ra,
     'declination': startSource.a_dec, 'freq1': 5428, 'freq2': 7500,
-    'project': args.project, 'scanLength': rapidlib.minutesToScanLength(5),
+    'project': args.project, 'scanLength': scanLengthCalibrator,
     'scanType': "Dwell"
 })
 nvisits = {}
-for i in xrange(0, len(segmentSeeds)):
-    if segmentSeeds[i] is None:
-        continue
+for i in seededIndices:
     totalSourceVisits += len(segmentOrdered[i])
-    for j in xrange(0, len(segmentOrdered[i])):
-        if segmentOrdered[i][j].name not in nvisits:
-            nvisits[segmentOrdered[i][j].name] = 1
-        else:
-            nvisits[segmentOrdered[i][j].name] += 1
-    schedule.addScan({
-        'source': "%s%d" % (args.mosaic, i),
-        'rightAscension': segmentEstimates[i]['refRA'],
-        'declination': segmentEstimates[i]['refDec'],
-        'scanType': "Mosaic", 'scanLength': rapidlib.minutesToScanLength(1)
-    })
+    for j in range(0, len(segmentOrdered[i])):
+        nvisits[segmentOrdered[i][j].name] = nvisits.get(segmentOrdered[i][j].name, 0) + 1
         #schedule.addScan({
         #    'source': segmentOrdered[i][j].name, 'rightAscension': segmentOrdered[i][j].a_ra,
         #    'declination': segmentOrdered[i][j].a_dec
         #})
-
-print "Total number of source visits = %d" % totalSourceVisits
+# Build all the mosaic scans first, then add them to the schedule in order.
+mosaicScans = [ {
+    'source': "%s%d" % (args.mosaic, i),
+    'rightAscension': segmentEstimates[i]['refRA'],
+    'declination': segmentEstimates[i]['refDec'],
+    'scanType': "Mosaic", 'scanLength': scanLengthMosaic
+} for i in seededIndices ]
+for scan in mosaicScans:
+    schedule.addScan(scan)
+
+print("Total number of source visits = %d" % totalSourceVisits)
 visitSummary = {}
+finishedSources = set()
 for src in nvisits:
-    print "Source %s is visited %d times" % (src, nvisits[src])
-    if nvisits[src] not in visitSummary:
-        visitSummary[nvisits[src]] = 1
-    else:
-        visitSummary[nvisits[src]] += 1
+    print("Source %s is visited %d times" % (src, nvisits[src]))
+    visitSummary[nvisits[src]] = visitSummary.get(nvisits[src], 0) + 1
     if nvisits[src] >= args.nvisits:
         # We can delete this source from the list.
-        for i in xrange(0, len(sourceList)):
-            if sourceList[i].name == src:
-                del sourceList[i]
-                break
-nn = 1
-while nn < 100:
-    if nn in visitSummary:
-        print "%d sources are visited %d times" % (visitSummary[nn], nn)
-    nn += 1
+        finishedSources.add(src)
+sourceList = [ s for s in sourceList if s.name not in finishedSources ]
+for nn in sorted(visitSummary):
+    print("%d sources are visited %d times" % (visitSummary[nn], nn))
     
 
 # Save the schedule.
@@ -717,29 +933,23 @@ schedule.write(name=args.output)
 
 # Output the altered list if asked to.
 if args.altered != "":
+    alteredSources = sourceList + removedSources
     if args.altered.endswith(".json"):
-        outObj = { 'sources': [] }
-        for i in xrange(0, len(sourceList)):
-            outObj['sources'].append({ 'name': sourceList[i].name,
-                                       'rightAscension': sourceList[i].a_ra,
-                                       'declination': sourceList[i].a_dec })
-        for i in xrange(0, len(removedSources)):
-            outObj['sources'].append({ 'name': removedSources[i].name,
-                                       'rightAscension': removedSources[i].a_ra,
-                                       'declination': removedSources[i].a_dec })
+        # Write each source as we go, rather than building the whole object first.
         with open(args.altered, 'w') as ofp:
-            json.dump(outObj, ofp)
+            ofp.write('{"sources":[')
+            for k in range(0, len(alteredSources)):
+                if k > 0:
+                    ofp.write(',')
+                json.dump({ 'name': alteredSources[k].name, 'rightAscension': alteredSources[k].a_ra,
+                            'declination': alteredSources[k].a_dec }, ofp, separators=(',', ':'))
+            ofp.write(']}')
     else:
-        with open(args.altered, 'w') as ofp:
-            for i in xrange(0, len(sourceList)):
-                oline = "%s%s%s%s%s\n" % (sourceList[i].name, args.csvdelim,
-                                          sourceList[i].a_ra, args.csvdelim,
-                                          sourceList[i].a_dec)
-                ofp.write(oline)
-            for i in xrange(0, len(removedSources)):
-                oline = "%s%s%s%s%s\n" % (removedSources[i].name, args.csvdelim,
-                                          removedSources[i].a_ra, args.csvdelim,
-                                          removedSources[i].a_dec)
-                ofp.write(oline)
-
-    
+        alteredRows = [ (s.name,) + coordinateStrings(s) for s in alteredSources ]
+        with open(args.altered, 'w', newline='') as ofp:
+            # The coordinates are given to the writer as strings, so they are
+            # output in sexagesimal form, as readSourceList expects them.
+            if len(args.csvdelim) == 1:
+                csv.writer(ofp, delimiter=args.csvdelim, lineterminator="\n").writerows(alteredRows)
+            else:
+                ofp.write("".join([ args.csvdelim.join(x) + "\n" for x in alteredRows ]))